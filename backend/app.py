@@ -1,52 +1,117 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory, stream_with_context
 from flask_cors import CORS
 from pymongo import MongoClient
-from bson import ObjectId
+from cachetools import TTLCache
+from werkzeug.exceptions import NotFound
+from marshmallow import ValidationError
 import os
+import re
+import atexit
+import itertools
 import subprocess
 import threading
 import time
 import signal
-from datetime import datetime
-from config import Config
+from datetime import datetime, timezone
+from config import get_config
 from utils.rtsp_converter import RTSPConverter
-from models.overlay import OverlayModel
+from utils.json_provider import ORJSONProvider
+from models.overlay import OverlayModel, to_object_id
 
 app = Flask(__name__)
-app.config.from_object(Config)
+app.config.from_object(get_config())
+app.json = ORJSONProvider(app)
 CORS(app)
 
-# Database connection
-client = MongoClient(app.config['MONGODB_URI'])
+# Database connection; connect=False defers socket setup until the first
+# operation, so the client gunicorn preloads is never opened before the fork
+client = MongoClient(
+    app.config['MONGODB_URI'],
+    connect=False,
+    **app.config['MONGODB_CLIENT_OPTIONS']
+)
 db = client[app.config['MONGODB_DB_NAME']]
 overlays_collection = db.overlays
 
+# Per-worker cache of overlays by ID, cleared on update/delete; TTL bounds
+# staleness for writes handled by other workers. TTLCache isn't thread-safe.
+overlay_cache = TTLCache(
+    maxsize=app.config['OVERLAY_CACHE_SIZE'],
+    ttl=app.config['OVERLAY_CACHE_TTL']
+)
+overlay_cache_lock = threading.Lock()
+
+# Cache fills that are racing writes: oid -> [reads_in_flight, writes_seen]
+# (guarded by overlay_cache_lock). A read only fills the cache if no write to
+# that ID landed while it was querying MongoDB, so a concurrent PUT/DELETE
+# can't be overwritten by the older document. Entries are dropped when the
+# last read of an ID finishes, so this only ever holds in-flight IDs.
+overlay_pending_reads = {}
+
+def evict_cached_overlay(oid):
+    """Drop a cached overlay after a write; call once the write has landed"""
+    with overlay_cache_lock:
+        pending = overlay_pending_reads.get(oid)
+        if pending:
+            pending[1] += 1
+        overlay_cache.pop(oid, None)
+
+def load_overlay(oid):
+    """Get an overlay from the cache, falling back to MongoDB"""
+    with overlay_cache_lock:
+        overlay = overlay_cache.get(oid)
+        if overlay is not None:
+            return overlay
+        pending = overlay_pending_reads.setdefault(oid, [0, 0])
+        pending[0] += 1
+        writes_seen = pending[1]
+    
+    overlay = None
+    try:
+        overlay = overlays_collection.find_one({"_id": oid})
+        return overlay
+    finally:
+        with overlay_cache_lock:
+            if overlay and pending[1] == writes_seen:
+                overlay_cache[oid] = overlay
+            pending[0] -= 1
+            if pending[0] == 0:
+                del overlay_pending_reads[oid]
+
 # Initialize RTSP converter
-rtsp_converter = RTSPConverter()
+rtsp_converter = RTSPConverter(output_dir=app.config['STREAM_OUTPUT_DIR'])
 
 # Initialize models
-overlay_model = OverlayModel(overlays_collection)
+overlay_model = OverlayModel(
+    overlays_collection,
+    max_legacy_offset=app.config['MAX_LEGACY_OFFSET']
+)
 
-# Global variables for stream management
-stream_active = False
+# Indexes are created by each worker on its first overlay request, so the
+# preloaded gunicorn master never talks to MongoDB before forking. Failures
+# are retried on the next overlay request; other routes never wait on it.
+_indexes_ready = False
+_indexes_lock = threading.Lock()
+OVERLAY_ENDPOINTS = {'get_overlays', 'create_overlay', 'get_overlay', 'update_overlay', 'delete_overlay'}
 
-# Utility functions
-def serialize_overlay(overlay):
-    """Convert MongoDB document to JSON-serializable format"""
-    overlay['_id'] = str(overlay['_id'])
-    return overlay
+@app.before_request
+def ensure_indexes():
+    global _indexes_ready
+    if _indexes_ready or request.endpoint not in OVERLAY_ENDPOINTS:
+        return
+    with _indexes_lock:
+        if _indexes_ready:
+            return
+        try:
+            overlay_model.ensure_indexes()
+            _indexes_ready = True
+        except Exception as e:
+            print(f"Error creating overlay indexes: {e}")
 
-def validate_overlay_data(data):
-    """Validate overlay data structure"""
-    required_fields = ['type', 'content', 'position', 'size']
-    for field in required_fields:
-        if field not in data:
-            return False, f"Missing required field: {field}"
-    
-    if data['type'] not in ['text', 'logo']:
-        return False, "Type must be 'text' or 'logo'"
-    
-    return True, "Valid"
+# Fields selectable with ?fields= on the overlay list. With equality filters
+# on both type and visible, ?fields=type,visible is answered from the
+# type_vis_id index without fetching documents
+LIST_FIELDS = set(overlay_model.schema.fields) | {'created_at', 'updated_at'}
 
 # Routes
 
@@ -64,13 +129,27 @@ def home():
 # Overlay CRUD Routes
 @app.route('/api/overlays', methods=['GET'])
 def get_overlays():
-    """Get all overlay settings"""
+    """Get overlay settings, newest first, paginated by `_id` cursor"""
     try:
         # Support query parameters
         type_filter = request.args.get('type')
         visible_filter = request.args.get('visible')
+        after = request.args.get('after')
         limit = int(request.args.get('limit', 50))
         offset = int(request.args.get('offset', 0))
+        fields = request.args.get('fields')
+        
+        # Trim the payload: ?fields=a,b returns only those fields (plus _id),
+        # ?thin=1 drops the potentially large content field
+        projection = None
+        if fields:
+            requested = [field for field in fields.split(',') if field]
+            unknown = set(requested) - LIST_FIELDS
+            if unknown:
+                return jsonify({"error": f"Unknown fields: {', '.join(sorted(unknown))}"}), 400
+            projection = {field: 1 for field in requested}
+        elif request.args.get('thin') == '1':
+            projection = {'content': 0}
         
         query = {}
         if type_filter:
@@ -78,8 +157,56 @@ def get_overlays():
         if visible_filter is not None:
             query['visible'] = visible_filter.lower() == 'true'
         
-        overlays = list(overlays_collection.find(query).skip(offset).limit(limit))
-        return jsonify([serialize_overlay(overlay) for overlay in overlays])
+        if after:
+            # Seek past the last item of the previous page via the _id index
+            after_id = to_object_id(after)
+            if after_id is None:
+                return jsonify({"error": "Invalid cursor format"}), 400
+            query['_id'] = {"$lt": after_id}
+            offset = 0
+        elif offset >= app.config['MAX_LEGACY_OFFSET']:
+            # skip() walks every skipped document, so legacy offset paging
+            # is only kept for small offsets
+            return jsonify({
+                "error": "Offset too large, use the 'after' cursor instead"
+            }), 400
+        
+        # Skip the query entirely when the client's copy is current
+        version = overlay_model.get_version()
+        if request.if_none_match.contains_weak(version):
+            response = Response(status=304)
+            response.set_etag(version, weak=True)
+            return response
+        
+        cursor = (
+            overlays_collection.find(query, projection)
+            .sort("_id", -1)
+            .skip(offset)
+            .limit(limit)
+            .batch_size(200)
+        )
+        # Fetch the first batch up front so query errors still return a 500
+        first = next(cursor, None)
+        
+        def generate():
+            """Encode overlays one at a time as they come off the cursor"""
+            dumpb = app.json.dumpb
+            last_id = None
+            try:
+                yield b'{"items":['
+                if first is not None:
+                    for overlay in itertools.chain([first], cursor):
+                        if last_id is not None:
+                            yield b','
+                        yield dumpb(overlay)
+                        last_id = overlay['_id']
+                yield b'],"next_cursor":' + dumpb(last_id) + b'}'
+            finally:
+                cursor.close()
+        
+        response = Response(stream_with_context(generate()), mimetype='application/json')
+        response.set_etag(version, weak=True)
+        return response
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -87,21 +214,19 @@ def get_overlays():
 def create_overlay():
     """Create a new overlay"""
     try:
-        data = request.get_json()
-        
-        # Validate data
-        is_valid, message = validate_overlay_data(data)
-        if not is_valid:
-            return jsonify({"error": message}), 400
+        # Validate data; the schema also fills in default values
+        try:
+            data = overlay_model.schema.load(request.get_json())
+        except ValidationError as err:
+            return jsonify({"error": "Invalid overlay data", "details": err.messages}), 400
         
-        # Add default values
-        data.setdefault('visible', True)
-        data.setdefault('layer', 1)
-        data['created_at'] = datetime.utcnow()
-        data['updated_at'] = datetime.utcnow()
+        # Add timestamps
+        now = datetime.now(timezone.utc)
+        data = {**data, 'created_at': now, 'updated_at': now}
         
         # Insert into database
         result = overlays_collection.insert_one(data)
+        overlay_model.invalidate_version()
         
         return jsonify({
             "_id": str(result.inserted_id),
@@ -115,14 +240,15 @@ def create_overlay():
 def get_overlay(overlay_id):
     """Get a specific overlay by ID"""
     try:
-        if not ObjectId.is_valid(overlay_id):
+        oid = to_object_id(overlay_id)
+        if oid is None:
             return jsonify({"error": "Invalid overlay ID format"}), 400
             
-        overlay = overlays_collection.find_one({"_id": ObjectId(overlay_id)})
+        overlay = load_overlay(oid)
         if not overlay:
             return jsonify({"error": "Overlay not found"}), 404
         
-        return jsonify(serialize_overlay(overlay))
+        return jsonify(overlay)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -130,16 +256,19 @@ def get_overlay(overlay_id):
 def update_overlay(overlay_id):
     """Update an existing overlay"""
     try:
-        if not ObjectId.is_valid(overlay_id):
+        oid = to_object_id(overlay_id)
+        if oid is None:
             return jsonify({"error": "Invalid overlay ID format"}), 400
             
         data = request.get_json()
-        data['updated_at'] = datetime.utcnow()
+        data['updated_at'] = datetime.now(timezone.utc)
         
         result = overlays_collection.update_one(
-            {"_id": ObjectId(overlay_id)},
+            {"_id": oid},
             {"$set": data}
         )
+        overlay_model.invalidate_version()
+        evict_cached_overlay(oid)
         
         if result.matched_count == 0:
             return jsonify({"error": "Overlay not found"}), 404
@@ -155,10 +284,13 @@ def update_overlay(overlay_id):
 def delete_overlay(overlay_id):
     """Delete an overlay"""
     try:
-        if not ObjectId.is_valid(overlay_id):
+        oid = to_object_id(overlay_id)
+        if oid is None:
             return jsonify({"error": "Invalid overlay ID format"}), 400
             
-        result = overlays_collection.delete_one({"_id": ObjectId(overlay_id)})
+        result = overlays_collection.delete_one({"_id": oid})
+        overlay_model.invalidate_version()
+        evict_cached_overlay(oid)
         
         if result.deleted_count == 0:
             return jsonify({"error": "Overlay not found"}), 404
@@ -174,7 +306,6 @@ def delete_overlay(overlay_id):
 @app.route('/api/stream/start', methods=['POST'])
 def start_stream():
     """Start RTSP stream conversion"""
-    global stream_active
     try:
         data = request.get_json()
         rtsp_url = data.get('rtsp_url')
@@ -190,12 +321,11 @@ def start_stream():
         success = rtsp_converter.start_conversion(rtsp_url)
         
         if success:
-            stream_active = True
             return jsonify({
                 "hls_url": f"http://localhost:5000/stream/playlist.m3u8",
                 "status": "started",
                 "rtsp_url": rtsp_url,
-                "started_at": datetime.utcnow().isoformat()
+                "started_at": datetime.now(timezone.utc).isoformat()
             })
         else:
             return jsonify({"error": "Failed to start stream conversion"}), 500
@@ -206,14 +336,12 @@ def start_stream():
 @app.route('/api/stream/stop', methods=['POST'])
 def stop_stream():
     """Stop the current stream"""
-    global stream_active
     try:
         rtsp_converter.stop_conversion()
-        stream_active = False
         return jsonify({
             "status": "stopped",
             "message": "Stream stopped successfully",
-            "stopped_at": datetime.utcnow().isoformat()
+            "stopped_at": datetime.now(timezone.utc).isoformat()
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -221,19 +349,40 @@ def stop_stream():
 @app.route('/api/stream/status', methods=['GET'])
 def stream_status():
     """Get current stream status"""
+    stream_active = rtsp_converter.is_stream_active()
     return jsonify({
         "active": stream_active,
         "hls_url": f"http://localhost:5000/stream/playlist.m3u8" if stream_active else None,
-        "timestamp": datetime.utcnow().isoformat()
+        "timestamp": datetime.now(timezone.utc).isoformat()
     })
 
 # Serve HLS files
+SEGMENT_NAME_RE = re.compile(r'segment_\d+\.ts')
+
 @app.route('/stream/<filename>')
 def serve_stream_file(filename):
     """Serve HLS playlist and segment files"""
+    # Only FFmpeg's own output names; anything else (e.g. 'ffmpeg.pid?.ts')
+    # could smuggle a query or path into the X-Accel-Redirect header
+    if filename == 'playlist.m3u8':
+        mimetype, cache_control = 'application/vnd.apple.mpegurl', 'no-cache'
+    elif SEGMENT_NAME_RE.fullmatch(filename):
+        mimetype, cache_control = 'video/mp2t', 'public, max-age=30'
+    else:
+        return jsonify({"error": "Stream file not found"}), 404
+    
     try:
-        return send_from_directory(app.config['STREAM_OUTPUT_DIR'], filename)
-    except FileNotFoundError:
+        if app.config['USE_X_ACCEL_REDIRECT']:
+            # Nginx sends the file itself; only headers go through Python
+            response = Response(mimetype=mimetype)
+            response.headers['X-Accel-Redirect'] = app.config['X_ACCEL_REDIRECT_PREFIX'] + filename
+        else:
+            response = send_from_directory(
+                app.config['STREAM_OUTPUT_DIR'], filename, mimetype=mimetype
+            )
+        response.headers['Cache-Control'] = cache_control
+        return response
+    except NotFound:
         return jsonify({"error": "Stream file not found"}), 404
 
 # Health check
@@ -251,15 +400,15 @@ def health_check():
             "status": "healthy",
             "mongodb": "connected",
             "stream_output_dir": "exists" if output_dir_exists else "missing",
-            "active_stream": stream_active,
-            "timestamp": datetime.utcnow().isoformat(),
+            "active_stream": rtsp_converter.is_stream_active(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
             "version": "1.0.0"
         })
     except Exception as e:
         return jsonify({
             "status": "unhealthy",
             "error": str(e),
-            "timestamp": datetime.utcnow().isoformat()
+            "timestamp": datetime.now(timezone.utc).isoformat()
         }), 500
 
 # Error handlers
@@ -278,17 +427,17 @@ def bad_request(error):
 # Cleanup on shutdown
 def cleanup():
     """Cleanup resources on shutdown"""
-    rtsp_converter.stop_conversion()
+    # Only this process's FFmpeg; other workers' streams must outlive it
+    rtsp_converter.stop_conversion(own_only=True)
     print("Cleanup completed")
 
+# Ensure stream output directory exists and register cleanup in every
+# process that imports the app (gunicorn workers as well as the dev server)
+os.makedirs(app.config['STREAM_OUTPUT_DIR'], exist_ok=True)
+atexit.register(cleanup)
+
 if __name__ == '__main__':
-    # Ensure stream output directory exists
-    os.makedirs(app.config['STREAM_OUTPUT_DIR'], exist_ok=True)
-    
-    # Register cleanup function
-    import atexit
-    atexit.register(cleanup)
-    
+    # Development server only; production runs under gunicorn (see Procfile)
     try:
         print(f"Starting RTSP Livestream API on port 5000...")
         print(f"MongoDB URI: {app.config['MONGODB_URI']}")
@@ -298,8 +447,7 @@ if __name__ == '__main__':
         app.run(
             debug=app.config['DEBUG'], 
             host='0.0.0.0', 
-            port=5000, 
-            threaded=True
+            port=5000
         )
     except KeyboardInterrupt:
         cleanup()
\ No newline at end of file
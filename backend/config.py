@@ -9,16 +9,31 @@ class Config:
     # Database Configuration
     MONGODB_URI = "mongodb://localhost:27017/"
     MONGODB_DB_NAME = "livestream"
+    MONGODB_CLIENT_OPTIONS = {
+        'maxPoolSize': 50,
+        'minPoolSize': 5,
+        'serverSelectionTimeoutMS': 2000,  # Fail health checks fast on outages
+        'connectTimeoutMS': 2000,
+        'socketTimeoutMS': 5000,
+        'w': 1,
+        'journal': False,
+        'retryWrites': True,
+        'compressors': 'zstd,zlib',  # zstd needs the zstandard package
+    }
     
     # Flask Configuration
     SECRET_KEY = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-production')
-    DEBUG = os.getenv('DEBUG', 'True').lower() == 'true'
+    DEBUG = os.getenv('DEBUG', 'False').lower() == 'true'
     
     # Stream Configuration
     STREAM_OUTPUT_DIR = "output"
     MAX_STREAM_DURATION = int(os.getenv('MAX_STREAM_DURATION', '3600'))  # 1 hour
     FFMPEG_PATH = os.getenv('FFMPEG_PATH', 'ffmpeg')
     
+    # Hand HLS file delivery to Nginx (see deploy/nginx.conf)
+    USE_X_ACCEL_REDIRECT = os.getenv('USE_X_ACCEL_REDIRECT', 'False').lower() == 'true'
+    X_ACCEL_REDIRECT_PREFIX = os.getenv('X_ACCEL_REDIRECT_PREFIX', '/internal-stream/')
+    
     # CORS Configuration
     ALLOWED_ORIGINS = os.getenv('ALLOWED_ORIGINS', 'http://localhost:3000,http://127.0.0.1:3000').split(',')
     
@@ -30,6 +45,9 @@ class Config:
     # Overlay Configuration
     MAX_OVERLAYS = int(os.getenv('MAX_OVERLAYS', '10'))
     MAX_OVERLAY_SIZE = int(os.getenv('MAX_OVERLAY_SIZE', '1000'))  # pixels
+    MAX_LEGACY_OFFSET = int(os.getenv('MAX_LEGACY_OFFSET', '1000'))  # use ?after= beyond this
+    OVERLAY_CACHE_SIZE = int(os.getenv('OVERLAY_CACHE_SIZE', '1024'))
+    OVERLAY_CACHE_TTL = int(os.getenv('OVERLAY_CACHE_TTL', '30'))  # seconds
     
     # Logging Configuration
     LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
@@ -1,3 +1,3 @@
-from .overlay import OverlayModel, OverlaySchema
+from .overlay import OverlayModel, OverlaySchema, to_object_id
 
-__all__ = ['OverlayModel', 'OverlaySchema']
\ No newline at end of file
+__all__ = ['OverlayModel', 'OverlaySchema', 'to_object_id']
\ No newline at end of file
@@ -1,28 +1,80 @@
+import time
 from bson import ObjectId
-from datetime import datetime
-from marshmallow import Schema, fields, ValidationError
+from bson.errors import InvalidId
+from datetime import datetime, timezone
+from marshmallow import Schema, fields, ValidationError, EXCLUDE
+
+def to_object_id(value):
+    """Parse an ObjectId string, returning None if it is malformed"""
+    # ObjectId(None) would generate a fresh id rather than fail
+    if not isinstance(value, str):
+        return None
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        return None
 
 class OverlaySchema(Schema):
     """Schema for overlay validation"""
+    
+    class Meta:
+        unknown = EXCLUDE  # Drop unexpected keys instead of raising
+    
     type = fields.Str(required=True, validate=lambda x: x in ['text', 'logo'])
     content = fields.Str(required=True)
     position = fields.Dict(required=True, keys=fields.Str(), values=fields.Integer())
     size = fields.Dict(required=True, keys=fields.Str(), values=fields.Integer())
     layer = fields.Integer(load_default=1)
-    style = fields.Dict(load_default={})
+    style = fields.Dict(load_default=dict)
     visible = fields.Bool(load_default=True)  # <-- Fix here
 
 class OverlayModel:
     """Model class for overlay operations"""
     
-    def __init__(self, collection):
+    VERSION_TTL = 1  # seconds a computed collection version is reused
+    
+    def __init__(self, collection, max_legacy_offset=1000):
         self.collection = collection
+        self.max_legacy_offset = max_legacy_offset
         self.schema = OverlaySchema()
+        self._version = None
+        self._version_expires = 0
+    
+    def ensure_indexes(self):
+        """Create the indexes used by overlay queries (idempotent)"""
+        # Serves the type/visible list filters plus the _id sort
+        self.collection.create_index(
+            [("type", 1), ("visible", 1), ("_id", -1)],
+            name="type_vis_id"
+        )
+        self.collection.create_index([("updated_at", -1)], name="updated_at")
+    
+    def get_version(self):
+        """Get a token that changes whenever the overlay collection changes.
+
+        Combines the document count (changed by deletes) with the latest
+        updated_at (changed by creates and updates). The value is cached
+        in-process for VERSION_TTL seconds.
+        """
+        now = time.monotonic()
+        if self._version is None or now >= self._version_expires:
+            latest = self.collection.find_one(
+                {}, {"_id": 0, "updated_at": 1}, sort=[("updated_at", -1)]
+            )
+            updated_at = latest.get("updated_at") if latest else None
+            count = self.collection.estimated_document_count()
+            self._version = f"{count}-{updated_at.isoformat() if updated_at else 0}"
+            self._version_expires = now + self.VERSION_TTL
+        return self._version
+    
+    def invalidate_version(self):
+        """Drop the cached collection version after a write"""
+        self._version = None
     
     def validate_overlay(self, data):
         """Validate overlay data"""
         try:
-            return self.schema.load(data)
+            return self.schema.load(data), None
         except ValidationError as err:
             return None, err.messages
     
@@ -33,23 +85,26 @@ class OverlayModel:
             return None, errors
         
         # Add timestamps
-        validated_data['created_at'] = datetime.utcnow()
-        validated_data['updated_at'] = datetime.utcnow()
+        now = datetime.now(timezone.utc)
+        validated_data['created_at'] = now
+        validated_data['updated_at'] = now
         
         # Validate position and size constraints
         if not self._validate_position_size(validated_data):
             return None, {"error": "Invalid position or size values"}
         
         result = self.collection.insert_one(validated_data)
+        self.invalidate_version()
         return str(result.inserted_id), None
     
     def get_overlay(self, overlay_id):
         """Get overlay by ID"""
         try:
-            if not ObjectId.is_valid(overlay_id):
+            oid = to_object_id(overlay_id)
+            if oid is None:
                 return None, {"error": "Invalid overlay ID"}
             
-            overlay = self.collection.find_one({"_id": ObjectId(overlay_id)})
+            overlay = self.collection.find_one({"_id": oid})
             return overlay, None
         except Exception as e:
             return None, {"error": str(e)}
@@ -57,15 +112,16 @@ class OverlayModel:
     def update_overlay(self, overlay_id, data):
         """Update overlay"""
         try:
-            if not ObjectId.is_valid(overlay_id):
+            oid = to_object_id(overlay_id)
+            if oid is None:
                 return False, {"error": "Invalid overlay ID"}
             
             # Add update timestamp
-            data['updated_at'] = datetime.utcnow()
+            data['updated_at'] = datetime.now(timezone.utc)
             
             # Validate position and size if provided
             if 'position' in data or 'size' in data:
-                overlay = self.collection.find_one({"_id": ObjectId(overlay_id)})
+                overlay = self.collection.find_one({"_id": oid})
                 if overlay:
                     test_data = overlay.copy()
                     test_data.update(data)
@@ -73,9 +129,10 @@ class OverlayModel:
                         return False, {"error": "Invalid position or size values"}
             
             result = self.collection.update_one(
-                {"_id": ObjectId(overlay_id)},
+                {"_id": oid},
                 {"$set": data}
             )
+            self.invalidate_version()
             
             return result.matched_count > 0, None
         except Exception as e:
@@ -84,24 +141,39 @@ class OverlayModel:
     def delete_overlay(self, overlay_id):
         """Delete overlay"""
         try:
-            if not ObjectId.is_valid(overlay_id):
+            oid = to_object_id(overlay_id)
+            if oid is None:
                 return False, {"error": "Invalid overlay ID"}
             
-            result = self.collection.delete_one({"_id": ObjectId(overlay_id)})
+            result = self.collection.delete_one({"_id": oid})
+            self.invalidate_version()
             return result.deleted_count > 0, None
         except Exception as e:
             return False, {"error": str(e)}
     
-    def get_all_overlays(self, filters=None, limit=50, offset=0):
-        """Get all overlays with optional filtering"""
+    def get_all_overlays(self, filters=None, limit=50, offset=0, after=None):
+        """Get overlays newest first with optional filtering.
+
+        Pass the `_id` of the last overlay of the previous page as `after` to
+        fetch the next page; `offset` is kept for backwards compatibility
+        below `max_legacy_offset`.
+        """
         try:
-            query = filters or {}
-            overlays = list(
-                self.collection.find(query)
-                .skip(offset)
-                .limit(limit)
-                .sort("created_at", -1)
-            )
+            query = dict(filters or {})
+            if after:
+                after_id = to_object_id(after)
+                if after_id is None:
+                    return None, {"error": "Invalid cursor"}
+                query['_id'] = {"$lt": after_id}
+            elif offset >= self.max_legacy_offset:
+                # skip() walks every skipped document
+                return None, {"error": "Offset too large, use the 'after' cursor instead"}
+            
+            cursor = self.collection.find(query)
+            if offset and not after:
+                cursor = cursor.skip(offset)
+            
+            overlays = list(cursor.sort("_id", -1).limit(limit))
             return overlays, None
         except Exception as e:
             return None, {"error": str(e)}
@@ -126,19 +198,27 @@ class OverlayModel:
         return True
     
     def get_overlay_stats(self):
-        """Get overlay statistics"""
+        """Get overlay statistics in a single aggregation pass"""
         try:
-            total = self.collection.count_documents({})
-            visible = self.collection.count_documents({"visible": True})
-            text_overlays = self.collection.count_documents({"type": "text"})
-            logo_overlays = self.collection.count_documents({"type": "logo"})
+            pipeline = [{
+                "$group": {
+                    "_id": None,
+                    "total": {"$sum": 1},
+                    "visible": {"$sum": {"$cond": [{"$eq": ["$visible", True]}, 1, 0]}},
+                    "text_overlays": {"$sum": {"$cond": [{"$eq": ["$type", "text"]}, 1, 0]}},
+                    "logo_overlays": {"$sum": {"$cond": [{"$eq": ["$type", "logo"]}, 1, 0]}}
+                }
+            }]
+            stats = next(self.collection.aggregate(pipeline), {})
+            total = stats.get("total", 0)
+            visible = stats.get("visible", 0)
             
             return {
                 "total": total,
                 "visible": visible,
                 "hidden": total - visible,
-                "text_overlays": text_overlays,
-                "logo_overlays": logo_overlays
+                "text_overlays": stats.get("text_overlays", 0),
+                "logo_overlays": stats.get("logo_overlays", 0)
             }, None
         except Exception as e:
             return None, {"error": str(e)}
\ No newline at end of file
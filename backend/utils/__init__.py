@@ -1,3 +1,4 @@
 from .rtsp_converter import RTSPConverter
+from .json_provider import ORJSONProvider
 
-__all__ = ['RTSPConverter']
\ No newline at end of file
+__all__ = ['RTSPConverter', 'ORJSONProvider']
\ No newline at end of file
@@ -0,0 +1,24 @@
+import orjson
+from flask.json.provider import DefaultJSONProvider
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson.
+
+    Values orjson can't encode natively (ObjectId, etc.) fall back to str(),
+    so MongoDB documents can be returned without manual serialization.
+    """
+    
+    # Never indent or sort, even in debug mode
+    compact = True
+    sort_keys = False
+    
+    def dumpb(self, obj):
+        """Serialize obj to JSON bytes"""
+        # pymongo returns naive datetimes that are UTC; mark them as such
+        return orjson.dumps(obj, default=str, option=orjson.OPT_NAIVE_UTC)
+    
+    def dumps(self, obj, **kwargs):
+        return self.dumpb(obj).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
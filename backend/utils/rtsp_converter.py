@@ -1,80 +1,84 @@
 import subprocess
 import os
+import json
 import time
+import signal
 import threading
-from datetime import datetime
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 class RTSPConverter:
     """Handle RTSP to HLS stream conversion using FFmpeg"""
     
+    # Hardware H.264 encoders, in order of preference
+    HW_ENCODERS = ('h264_nvenc', 'h264_qsv', 'h264_vaapi')
+    VAAPI_DEVICE = '/dev/dri/renderD128'
+    
+    # FFmpeg messages meaning the hardware encoder itself could not start
+    ENCODER_INIT_ERRORS = (
+        'Cannot load',
+        'No NVENC capable devices',
+        'No capable devices found',
+        'Failed to initialise VAAPI',
+        'Device creation failed',
+        'Error initializing output stream',
+        'Error while opening encoder'
+    )
+    
+    # Seconds between sweeps of stale segments while a stream runs
+    JANITOR_INTERVAL = 30
+    
+    # FFmpeg stderr lines kept to explain a failed start
+    STDERR_TAIL_LINES = 20
+    
     def __init__(self, output_dir="stream_output"):
         self.process = None
         self.output_dir = output_dir
         self.is_running = False
         self.start_time = None
         self.rtsp_url = None
+        self._janitor_stop = threading.Event()
         
         # Ensure output directory exists
         os.makedirs(self.output_dir, exist_ok=True)
+        
+        # Encoder used when a source has to be transcoded
+        self._vcodec = self._detect_video_encoder()
     
     def start_conversion(self, rtsp_url):
         """Start converting RTSP stream to HLS format"""
+        # Held across stop and launch so two workers can't both start FFmpeg
+        with self._control_lock():
+            return self._start_locked(rtsp_url)
+    
+    def _start_locked(self, rtsp_url):
         try:
-            # Stop any existing stream
-            self.stop_conversion()
+            # Stop any existing stream, including one owned by another worker
+            self._stop_locked()
             
             self.rtsp_url = rtsp_url
-            self.start_time = datetime.utcnow()
-            
-            # HLS output path
-            playlist_path = os.path.join(self.output_dir, 'playlist.m3u8')
-            segment_pattern = os.path.join(self.output_dir, 'segment_%03d.ts')
-            
-            # FFmpeg command for RTSP to HLS conversion
-            cmd = [
-                'ffmpeg',
-                '-i', rtsp_url,
-                '-c:v', 'libx264',           # Video codec
-                '-c:a', 'aac',               # Audio codec
-                '-preset', 'ultrafast',      # Encoding speed
-                '-tune', 'zerolatency',      # Low latency
-                '-f', 'hls',                 # Output format
-                '-hls_time', '2',            # Segment duration (seconds)
-                '-hls_list_size', '5',       # Number of segments in playlist
-                '-hls_flags', 'delete_segments+append_list',  # Cleanup old segments
-                '-hls_segment_filename', segment_pattern,
-                '-y',                        # Overwrite output files
-                playlist_path
-            ]
-            
-            print(f"Starting RTSP conversion: {' '.join(cmd)}")
-            
-            # Start FFmpeg process
-            self.process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True
-            )
+            self.start_time = datetime.now(timezone.utc)
             
-            # Monitor process in separate thread
-            self.is_running = True
-            monitor_thread = threading.Thread(target=self._monitor_process)
-            monitor_thread.daemon = True
-            monitor_thread.start()
+            codecs = self._probe_codecs(rtsp_url)
+            input_args, codec_args = self._codec_args(*codecs)
+            started, stderr_tail = self._launch(rtsp_url, input_args, codec_args)
             
-            # Wait a moment to check if process started successfully
-            time.sleep(2)
+            # Encoders can be compiled in without the hardware present; only
+            # an encoder/device init failure justifies retrying in software
+            if (not started and self._vcodec != 'libx264' and self._vcodec in codec_args
+                    and self._is_encoder_init_error(stderr_tail)):
+                print(f"{self._vcodec} unavailable, falling back to libx264")
+                self._vcodec = 'libx264'
+                input_args, codec_args = self._codec_args(*codecs)
+                started, stderr_tail = self._launch(rtsp_url, input_args, codec_args)
             
-            if self.process.poll() is None:  # Process is still running
-                print(f"RTSP conversion started successfully for: {rtsp_url}")
-                return True
-            else:
-                # Process terminated immediately
-                stdout, stderr = self.process.communicate()
-                print(f"FFmpeg failed to start: {stderr}")
-                self.is_running = False
-                return False
+            return started
                 
         except FileNotFoundError:
             print("FFmpeg not found. Please install FFmpeg and ensure it's in your PATH.")
@@ -83,12 +87,102 @@ class RTSPConverter:
             print(f"Error starting RTSP conversion: {e}")
             return False
     
-    def stop_conversion(self):
-        """Stop the current RTSP conversion"""
-        if self.process and self.is_running:
+    def _launch(self, rtsp_url, input_args, codec_args):
+        """Run FFmpeg and report whether it survived startup.
+
+        Returns (started, stderr_tail), the tail holding FFmpeg's last stderr
+        lines.
+        """
+        # HLS output path
+        playlist_path = self._playlist_path()
+        segment_pattern = os.path.join(self.output_dir, 'segment_%03d.ts')
+        
+        # FFmpeg command for RTSP to HLS conversion
+        cmd = ['ffmpeg', '-fflags', 'nobuffer'] + input_args
+        cmd += self._transport_args(rtsp_url)
+        cmd += ['-i', rtsp_url]
+        cmd += codec_args
+        cmd += [
+            '-f', 'hls',                 # Output format
+            '-hls_time', '2',            # Segment duration (seconds)
+            '-hls_list_size', '5',       # Number of segments in playlist
+            '-hls_flags', 'delete_segments+append_list',  # Cleanup old segments
+            '-hls_segment_filename', segment_pattern,
+            '-y',                        # Overwrite output files
+            playlist_path
+        ]
+        
+        print(f"Starting RTSP conversion: {' '.join(cmd)}")
+        
+        # Start FFmpeg process. stdout is never read, so discard it rather
+        # than let the pipe fill; stream metadata isn't always UTF-8, so
+        # undecodable stderr bytes are replaced instead of raising
+        self.process = subprocess.Popen(
+            cmd,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            bufsize=1,
+            encoding='utf-8',
+            errors='replace'
+        )
+        self._write_pid(self.process.pid)
+        
+        # Monitor process in separate thread
+        self.is_running = True
+        stderr_tail = deque(maxlen=self.STDERR_TAIL_LINES)
+        monitor_thread = threading.Thread(target=self._monitor_process, args=(stderr_tail,))
+        monitor_thread.daemon = True
+        monitor_thread.start()
+        
+        # Sweep stale segments off the request path; FFmpeg's
+        # delete_segments does the primary cleanup
+        self._janitor_stop = threading.Event()
+        janitor_thread = threading.Thread(target=self._janitor, args=(self._janitor_stop,))
+        janitor_thread.daemon = True
+        janitor_thread.start()
+        
+        # Wait a moment to check if process started successfully
+        time.sleep(2)
+        
+        if self.process.poll() is None:  # Process is still running
+            print(f"RTSP conversion started successfully for: {rtsp_url}")
+            return True, stderr_tail
+        
+        # Process terminated immediately; let the monitor thread finish
+        # draining stderr, then report its last lines
+        monitor_thread.join(timeout=1)
+        print(f"FFmpeg failed to start (exit code {self.process.returncode}):")
+        print(''.join(stderr_tail).rstrip())
+        self.is_running = False
+        self._janitor_stop.set()
+        self._remove_pid(self.process.pid)
+        return False, stderr_tail
+    
+    def _is_encoder_init_error(self, stderr_lines):
+        """Check FFmpeg output for a hardware encoder/device init failure"""
+        return any(
+            marker in line
+            for line in stderr_lines
+            for marker in self.ENCODER_INIT_ERRORS
+        )
+    
+    def stop_conversion(self, own_only=False):
+        """Stop the current RTSP conversion, whichever worker started it.
+
+        With own_only=True only an FFmpeg started by this process is stopped,
+        as needed when a worker exits.
+        """
+        with self._control_lock():
+            self._stop_locked(own_only)
+    
+    def _stop_locked(self, own_only=False):
+        """Stop FFmpeg; the caller must hold the control lock"""
+        if self.process and self.is_running and self.process.poll() is None:
             try:
                 print("Stopping RTSP conversion...")
                 self.is_running = False
+                self._janitor_stop.set()
+                pid = self.process.pid
                 
                 # Terminate the process gracefully
                 self.process.terminate()
@@ -110,34 +204,242 @@ class RTSPConverter:
                 self.process = None
                 self.rtsp_url = None
                 self.start_time = None
+                self._remove_pid(pid)
+                self._remove_playlist()
+            return
+        
+        if own_only:
+            return
+        
+        # FFmpeg may have been started by another worker; signal it by PID
+        pid = self._running_pid()
+        if pid is None:
+            return
+        try:
+            print(f"Stopping RTSP conversion (pid {pid})...")
+            os.kill(pid, signal.SIGTERM)
+            deadline = time.monotonic() + 5
+            while self._pid_alive(pid):
+                if time.monotonic() >= deadline:
+                    print("Force killing FFmpeg process...")
+                    os.kill(pid, getattr(signal, 'SIGKILL', signal.SIGTERM))
+                    break
+                time.sleep(0.1)
+            print("RTSP conversion stopped")
+        except ProcessLookupError:
+            pass  # Exited on its own meanwhile
+        except Exception as e:
+            print(f"Error stopping RTSP conversion: {e}")
+        finally:
+            self._remove_pid(pid)
+            self._remove_playlist()
     
-    def _monitor_process(self):
-        """Monitor FFmpeg process and handle errors"""
+    def _monitor_process(self, stderr_tail):
+        """Monitor FFmpeg process and handle errors.
+
+        The last lines of stderr are kept in stderr_tail so a failed start
+        can report its cause.
+        """
         if not self.process:
             return
         
+        process = self.process
         try:
-            # Read stderr in real-time
-            while self.is_running and self.process.poll() is None:
-                line = self.process.stderr.readline()
-                if line:
-                    # Log FFmpeg output (you can filter this based on your needs)
-                    if "error" in line.lower() or "failed" in line.lower():
-                        print(f"FFmpeg error: {line.strip()}")
-                
-                time.sleep(0.1)
+            # Blocks until FFmpeg writes a line and ends at EOF when it exits
+            for line in process.stderr:
+                stderr_tail.append(line)
+                # Log FFmpeg output (you can filter this based on your needs)
+                if self.is_running and ("error" in line.lower() or "failed" in line.lower()):
+                    print(f"FFmpeg error: {line.strip()}")
             
             # Process has terminated
-            if self.process.poll() is not None:
-                stdout, stderr = self.process.communicate()
-                if stderr and self.is_running:  # Only log if we didn't stop intentionally
-                    print(f"FFmpeg process ended with error: {stderr}")
-                
-                self.is_running = False
+            returncode = process.wait()
+            self._remove_pid(process.pid)
+            if self.process is not process:  # A newer stream has replaced this one
+                return
+            if self.is_running:  # Only log if we didn't stop intentionally
+                print(f"FFmpeg process ended with exit code {returncode}")
+            
+            self.is_running = False
+            self._janitor_stop.set()
                 
         except Exception as e:
             print(f"Error monitoring FFmpeg process: {e}")
-            self.is_running = False
+            if self.process is process:
+                self.is_running = False
+    
+    def _codec_args(self, video_codec, audio_codec):
+        """Get (input, output) FFmpeg args for the source's codecs.
+
+        Each stream is copied when HLS can carry it as-is. Otherwise audio
+        (typically G.711 from IP cameras) goes to AAC and video to the
+        encoder picked by _detect_video_encoder.
+        """
+        # No audio codec from a successful probe means the source has no audio
+        if audio_codec == 'aac' or (audio_codec is None and video_codec is not None):
+            audio_args = ['-c:a', 'copy']
+        else:
+            audio_args = ['-c:a', 'aac']
+        
+        if video_codec == 'h264':
+            return [], ['-c:v', 'copy'] + audio_args
+        
+        input_args = []
+        if self._vcodec == 'h264_nvenc':
+            video_args = ['-c:v', 'h264_nvenc', '-preset', 'p1', '-tune', 'll']
+        elif self._vcodec == 'h264_qsv':
+            video_args = ['-c:v', 'h264_qsv', '-preset', 'veryfast']
+        elif self._vcodec == 'h264_vaapi':
+            input_args = ['-vaapi_device', self.VAAPI_DEVICE]
+            video_args = ['-vf', 'format=nv12,hwupload', '-c:v', 'h264_vaapi']
+        else:
+            video_args = [
+                '-c:v', 'libx264',       # Video codec
+                '-preset', 'ultrafast',  # Encoding speed
+                '-tune', 'zerolatency'   # Low latency
+            ]
+        
+        return input_args, video_args + audio_args
+    
+    def _detect_video_encoder(self):
+        """Pick the best H.264 encoder this FFmpeg build offers"""
+        try:
+            result = subprocess.run(
+                ['ffmpeg', '-hide_banner', '-encoders'],
+                capture_output=True,
+                text=True,
+                timeout=10
+            )
+        except (FileNotFoundError, subprocess.TimeoutExpired):
+            return 'libx264'
+        
+        available = {line.split()[1] for line in result.stdout.splitlines() if len(line.split()) > 1}
+        for encoder in self.HW_ENCODERS:
+            if encoder not in available:
+                continue
+            if encoder == 'h264_vaapi' and not os.path.exists(self.VAAPI_DEVICE):
+                continue
+            return encoder
+        return 'libx264'
+    
+    def _transport_args(self, rtsp_url):
+        """Input args that read RTSP over TCP to avoid UDP packet loss"""
+        if rtsp_url.startswith('rtsp://'):
+            return ['-rtsp_transport', 'tcp']
+        return []
+    
+    def _run_ffprobe(self, rtsp_url):
+        """Run ffprobe on a stream with the same transport FFmpeg uses"""
+        cmd = ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_streams']
+        cmd += self._transport_args(rtsp_url)
+        cmd += [
+            '-timeout', '10000000',  # 10 seconds timeout
+            rtsp_url
+        ]
+        
+        return subprocess.run(
+            cmd,
+            capture_output=True,
+            text=True,
+            timeout=15
+        )
+    
+    def _probe_codecs(self, rtsp_url):
+        """Return the (video, audio) codec names of a stream, None if unknown"""
+        try:
+            result = self._run_ffprobe(rtsp_url)
+            if result.returncode != 0:
+                return None, None
+            
+            codecs = {}
+            for stream in json.loads(result.stdout).get('streams', []):
+                codecs.setdefault(stream.get('codec_type'), stream.get('codec_name'))
+            return codecs.get('video'), codecs.get('audio')
+            
+        except Exception as e:
+            print(f"Error probing stream codecs: {e}")
+            return None, None
+    
+    def _janitor(self, stop_event):
+        """Periodically remove stale segments until stop_event is set"""
+        while not stop_event.wait(self.JANITOR_INTERVAL):
+            self.cleanup_old_segments()
+    
+    def _playlist_path(self):
+        return os.path.join(self.output_dir, 'playlist.m3u8')
+    
+    def is_stream_active(self):
+        """Check whether FFmpeg is running in this or any other worker"""
+        return self.is_running or self._running_pid() is not None
+    
+    def _pid_path(self):
+        return os.path.join(self.output_dir, 'ffmpeg.pid')
+    
+    def _read_pid(self):
+        try:
+            with open(self._pid_path()) as f:
+                return int(f.read().strip())
+        except (FileNotFoundError, ValueError):
+            return None
+    
+    def _write_pid(self, pid):
+        # Written atomically since other workers read it without the lock
+        tmp_path = self._pid_path() + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(pid))
+        os.replace(tmp_path, self._pid_path())
+    
+    def _remove_pid(self, pid):
+        """Remove the PID file if it still records pid"""
+        if self._read_pid() == pid:
+            try:
+                os.remove(self._pid_path())
+            except FileNotFoundError:
+                pass
+    
+    def _running_pid(self):
+        """PID of the FFmpeg recorded in the output dir, None if not running"""
+        pid = self._read_pid()
+        if pid is not None and self._pid_alive(pid):
+            return pid
+        return None
+    
+    def _pid_alive(self, pid):
+        if os.path.isdir('/proc/self'):
+            # The cmdline check also rejects zombies (empty cmdline) and a
+            # PID reused by an unrelated process
+            try:
+                with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                    return b'ffmpeg' in f.read()
+            except OSError:
+                return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+    
+    def _remove_playlist(self):
+        # Other workers would otherwise serve the last playlist of a dead stream
+        try:
+            os.remove(self._playlist_path())
+        except FileNotFoundError:
+            pass
+    
+    @contextmanager
+    def _control_lock(self):
+        """Serialize start/stop across the workers sharing output_dir"""
+        if fcntl is None:  # No flock on Windows; dev server is single-process
+            yield
+            return
+        with open(os.path.join(self.output_dir, 'stream.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
     
     def get_status(self):
         """Get current conversion status"""
@@ -145,22 +447,26 @@ class RTSPConverter:
             "is_running": self.is_running,
             "rtsp_url": self.rtsp_url,
             "start_time": self.start_time.isoformat() if self.start_time else None,
-            "duration": (datetime.utcnow() - self.start_time).total_seconds() if self.start_time else 0,
-            "playlist_exists": os.path.exists(os.path.join(self.output_dir, 'playlist.m3u8'))
+            "duration": (datetime.now(timezone.utc) - self.start_time).total_seconds() if self.start_time else 0,
+            "playlist_exists": os.path.exists(self._playlist_path())
         }
     
     def cleanup_old_segments(self, max_age_seconds=300):
         """Clean up old segment files (older than max_age_seconds)"""
         try:
-            current_time = time.time()
-            for filename in os.listdir(self.output_dir):
-                if filename.endswith('.ts'):
-                    file_path = os.path.join(self.output_dir, filename)
-                    file_age = current_time - os.path.getctime(file_path)
-                    
-                    if file_age > max_age_seconds:
-                        os.remove(file_path)
-                        print(f"Removed old segment: {filename}")
+            cutoff = time.time() - max_age_seconds
+            # scandir entries cache their stat() result, one syscall per file
+            with os.scandir(self.output_dir) as entries:
+                for entry in entries:
+                    if not entry.name.endswith('.ts'):
+                        continue
+                    try:
+                        # mtime rather than ctime, which changes on any inode update
+                        if entry.stat().st_mtime < cutoff:
+                            os.unlink(entry.path)
+                            print(f"Removed old segment: {entry.name}")
+                    except FileNotFoundError:
+                        pass  # Already removed by FFmpeg's delete_segments
                         
         except Exception as e:
             print(f"Error cleaning up segments: {e}")
@@ -168,21 +474,7 @@ class RTSPConverter:
     def validate_rtsp_url(self, rtsp_url):
         """Validate RTSP URL by attempting a quick probe"""
         try:
-            cmd = [
-                'ffprobe',
-                '-v', 'quiet',
-                '-print_format', 'json',
-                '-show_streams',
-                '-timeout', '10000000',  # 10 seconds timeout
-                rtsp_url
-            ]
-            
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=15
-            )
+            result = self._run_ffprobe(rtsp_url)
             
             return result.returncode == 0
             
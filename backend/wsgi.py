@@ -0,0 +1,11 @@
+# WSGI entrypoint for gunicorn (see Procfile)
+import os
+
+# Serving through gunicorn means production unless FLASK_ENV is set
+# explicitly; must happen before config.py loads .env (which says development)
+os.environ.setdefault('FLASK_ENV', 'production')
+
+from app import app
+
+if __name__ == '__main__':
+    app.run()
@@ -13,7 +13,7 @@ export const useOverlays = () => {
     
     try {
       const data = await overlayAPI.getAll();
-      setOverlays(data);
+      setOverlays(data.items);
     } catch (error) {
       const errorMessage = apiUtils.handleError(error, 'Failed to fetch overlays');
       setError(errorMessage);